@@ -6,17 +6,36 @@ A script to create Spotify playlists with specified songs. Supports both public
 with configurable settings through environment variables or command line arguments.
 """
 
+from __future__ import annotations
+
 import os
 import argparse
+import asyncio
+import hashlib
+import json
 import sys
-from typing import List, Optional
+from typing import TYPE_CHECKING, Dict, List, Optional
 from dotenv import load_dotenv
-import spotipy
-from spotipy.oauth2 import SpotifyOAuth
+import orjson
+from rapidfuzz.distance import Levenshtein
+from rapidfuzz.utils import default_process
+
+# spotipy and aiohttp are imported where they are used so --help and
+# configuration errors don't pay for loading them
+if TYPE_CHECKING:
+    import aiohttp
+    import spotipy
 
 # Load environment variables
 load_dotenv()
 
+SPOTIFY_API_URL = "https://api.spotify.com/v1"
+TRACKS_BATCH_SIZE = 50  # Spotify API allows max 50 IDs per /tracks request
+SEARCH_LIMIT = 10  # Candidates fetched per search to pick the best match from
+# Bump whenever the search or matching strategy changes, so matches cached
+# by an older strategy are searched again instead of being trusted
+SEARCH_CACHE_VERSION = 2
+
 def parse_arguments():
     """Parse command line arguments"""
     parser = argparse.ArgumentParser(
@@ -81,6 +100,12 @@ Examples:
         help="Path for OAuth cache (default: %(default)s)"
     )
     
+    parser.add_argument(
+        "--search-cache", "-C",
+        default=os.getenv("SPOTIFY_SEARCH_CACHE", "~/.cache/spotify_playlist/search.json"),
+        help="Path for the track search cache (default: %(default)s)"
+    )
+    
     parser.add_argument(
         "--verbose", "-v",
         action="store_true",
@@ -91,6 +116,9 @@ Examples:
 
 def get_spotify_client(redirect_uri: str, scope: str, cache_path: str) -> spotipy.Spotify:
     """Initialize and authenticate Spotify client"""
+    import spotipy
+    from spotipy.oauth2 import SpotifyOAuth
+    
     try:
         sp = spotipy.Spotify(
             auth_manager=SpotifyOAuth(
@@ -122,35 +150,134 @@ def get_default_songs() -> List[str]:
         "Livin' la Vida Loca - Ricky Martin"
     ]
 
-def search_tracks(sp: spotipy.Spotify, songs: List[str], verbose: bool = False) -> List[str]:
-    """Search for tracks and return their URIs"""
+def build_search_query(song: str) -> str:
+    """Build a field-filtered search query from a 'Song - Artist' string"""
+    title, separator, artist = song.partition(" - ")
+    if not separator:
+        return song
+    return f"track:{title.strip()} artist:{artist.strip()}"
+
+def best_match(song: str, tracks: List[dict]) -> dict:
+    """Pick the track closest to a 'Song - Artist' string, preferring the earliest release"""
+    return min(tracks, key=lambda track: (
+        Levenshtein.distance(f"{track['name']} - {track['artists'][0]['name']}", song, processor=default_process),
+        track['album'].get('release_date', '')
+    ))
+
+def song_cache_key(song: str) -> str:
+    """Return the search cache key for a song"""
+    return hashlib.sha1(song.encode()).hexdigest()
+
+def load_search_cache(cache_path: str) -> Dict[str, str]:
+    """Load previously resolved track URIs from the search cache, ignoring outdated caches"""
+    try:
+        with open(os.path.expanduser(cache_path)) as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(data, dict) or data.get("version") != SEARCH_CACHE_VERSION:
+        return {}
+    return data.get("matches", {})
+
+def save_search_cache(cache_path: str, cache: Dict[str, str]) -> None:
+    """Persist resolved track URIs to the search cache"""
+    path = os.path.expanduser(cache_path)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            json.dump({"version": SEARCH_CACHE_VERSION, "matches": cache}, f)
+    except OSError as e:
+        print(f"  Could not write search cache '{path}': {e}")
+
+async def search_tracks_async(token: str, songs: List[str], concurrency: int = 10, verbose: bool = False,
+                              cache_path: Optional[str] = None) -> List[str]:
+    """Search for tracks concurrently and return their URIs, reusing cached matches where possible"""
+    import aiohttp
+    
+    semaphore = asyncio.Semaphore(concurrency)
+    
+    async def _get(session: aiohttp.ClientSession, url: str, params: dict) -> dict:
+        async with semaphore:
+            for attempt in range(3):
+                async with session.get(url, params=params) as resp:
+                    # Honor rate limiting before giving up on the request
+                    if resp.status == 429 and attempt < 2:
+                        retry_after = int(resp.headers.get("Retry-After", 1))
+                        if verbose:
+                            print(f"  Rate limited. Waiting {retry_after} seconds...")
+                        await asyncio.sleep(retry_after)
+                        continue
+                    resp.raise_for_status()
+                    return orjson.loads(await resp.read())
+    
+    async def _search(session: aiohttp.ClientSession, song: str) -> list:
+        params = {"q": build_search_query(song), "type": "track", "limit": SEARCH_LIMIT, "market": "from_token"}
+        result = await _get(session, f"{SPOTIFY_API_URL}/search", params)
+        return result['tracks']['items']
+    
+    async def _lookup(session: aiohttp.ClientSession, batch: List[str]) -> list:
+        ids = [cache[song_cache_key(song)].split(":")[-1] for song in batch]
+        result = await _get(session, f"{SPOTIFY_API_URL}/tracks", {"ids": ",".join(ids), "market": "from_token"})
+        return result['tracks']
+    
+    cache = load_search_cache(cache_path) if cache_path else {}
+    cached = [song for song in songs if song_cache_key(song) in cache]
+    to_search = [song for song in songs if song_cache_key(song) not in cache]
+    matches = {}
+    errors = {}
+    
+    async with aiohttp.ClientSession(headers={"Authorization": f"Bearer {token}"}) as session:
+        # Resolve cached songs in batches; stale entries fall back to a search
+        batches = [cached[i:i + TRACKS_BATCH_SIZE] for i in range(0, len(cached), TRACKS_BATCH_SIZE)]
+        lookups = await asyncio.gather(*[_lookup(session, batch) for batch in batches], return_exceptions=True)
+        for batch, tracks in zip(batches, lookups):
+            if isinstance(tracks, Exception):
+                to_search.extend(batch)
+                continue
+            for song, track in zip(batch, tracks):
+                if track:
+                    matches[song] = [track]
+                else:
+                    cache.pop(song_cache_key(song), None)
+                    to_search.append(song)
+        
+        if verbose and cached:
+            print(f"Resolved {len(matches)} of {len(songs)} songs from cache")
+        
+        searches = await asyncio.gather(*[_search(session, song) for song in to_search], return_exceptions=True)
+        for song, tracks in zip(to_search, searches):
+            if isinstance(tracks, Exception):
+                errors[song] = tracks
+            else:
+                matches[song] = tracks
+    
     track_uris = []
     not_found = []
     
     for i, song in enumerate(songs, 1):
         if verbose:
-            print(f"Searching for song {i}/{len(songs)}: {song}")
+            print(f"Searched for song {i}/{len(songs)}: {song}")
         
-        try:
-            result = sp.search(q=song, type='track', limit=1)
-            tracks = result['tracks']['items']
+        if song in errors:
+            print(f"  Error searching for '{song}': {errors[song]}")
+            not_found.append(song)
+            continue
+        
+        tracks = matches.get(song)
+        if tracks:
+            track = best_match(song, tracks)
+            track_uri = track['uri']
+            track_name = track['name']
+            artist_name = track['artists'][0]['name']
+            track_uris.append(track_uri)
+            cache[song_cache_key(song)] = track_uri
             
-            if tracks:
-                track_uri = tracks[0]['uri']
-                track_name = tracks[0]['name']
-                artist_name = tracks[0]['artists'][0]['name']
-                track_uris.append(track_uri)
-                
-                if verbose:
-                    print(f"  Found: {track_name} by {artist_name}")
-            else:
-                not_found.append(song)
-                if verbose:
-                    print(f"  Not found: {song}")
-                    
-        except Exception as e:
-            print(f"  Error searching for '{song}': {e}")
+            if verbose:
+                print(f"  Found: {track_name} by {artist_name}")
+        else:
             not_found.append(song)
+            if verbose:
+                print(f"  Not found: {song}")
     
     # Report summary
     print(f"\nSearch Results:")
@@ -160,17 +287,20 @@ def search_tracks(sp: spotipy.Spotify, songs: List[str], verbose: bool = False)
         for song in not_found:
             print(f"    - {song}")
     
+    if cache_path and to_search:
+        save_search_cache(cache_path, cache)
+    
     return track_uris
 
-def create_playlist(sp: spotipy.Spotify, name: str, description: str, public: bool, verbose: bool = False) -> dict:
-    """Create a new playlist"""
+def create_playlist(sp: spotipy.Spotify, current_user: dict, name: str, description: str, public: bool,
+                    verbose: bool = False) -> dict:
+    """Create a new playlist for the authenticated user"""
     try:
-        user_id = sp.current_user()['id']
         if verbose:
-            print(f"Creating playlist for user: {sp.current_user()['display_name']}")
+            print(f"Creating playlist for user: {current_user['display_name']}")
         
         playlist = sp.user_playlist_create(
-            user=user_id,
+            user=current_user['id'],
             name=name,
             public=public,
             description=description
@@ -197,7 +327,8 @@ def add_tracks_to_playlist(sp: spotipy.Spotify, playlist_id: str, track_uris: Li
         if verbose:
             print(f"\nAdding {len(track_uris)} tracks to playlist...")
         
-        # Spotify API allows max 100 tracks per request
+        # Spotify API allows max 100 tracks per request. Batches are added one
+        # after another so the playlist keeps the order of the song list.
         batch_size = 100
         for i in range(0, len(track_uris), batch_size):
             batch = track_uris[i:i + batch_size]
@@ -231,6 +362,13 @@ def main():
     
     # Get songs list
     songs = args.songs if args.songs else get_default_songs()
+    
+    # Drop repeated songs, keeping the first occurrence
+    unique_songs = list(dict.fromkeys(songs))
+    if args.verbose and len(unique_songs) < len(songs):
+        print(f"Removed {len(songs) - len(unique_songs)} duplicate songs")
+    songs = unique_songs
+    
     print(f"Playlist: {args.name}")
     print(f"Description: {args.description}")
     print(f"Visibility: {'Private' if args.private else 'Public'}")
@@ -244,11 +382,13 @@ def main():
     # Initialize Spotify client
     print(f"\nAuthenticating with Spotify...")
     sp = get_spotify_client(args.redirect_uri, args.scope, args.cache_path)
-    print(f"Logged in as: {sp.current_user()['display_name']}")
+    current_user = sp.current_user()
+    print(f"Logged in as: {current_user['display_name']}")
     
     # Search for tracks
     print(f"\nSearching for tracks...")
-    track_uris = search_tracks(sp, songs, args.verbose)
+    token = sp.auth_manager.get_access_token(as_dict=False)
+    track_uris = asyncio.run(search_tracks_async(token, songs, verbose=args.verbose, cache_path=args.search_cache))
     
     if not track_uris:
         print("No tracks found. Cannot create playlist.")
@@ -256,7 +396,7 @@ def main():
     
     # Create playlist
     print(f"\nCreating playlist...")
-    playlist = create_playlist(sp, args.name, args.description, not args.private, args.verbose)
+    playlist = create_playlist(sp, current_user, args.name, args.description, not args.private, args.verbose)
     
     # Add tracks
     success = add_tracks_to_playlist(sp, playlist['id'], track_uris, args.verbose)
@@ -1,191 +1,325 @@
 import requests
-import pandas as pd
-import time
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
+import csv
+import gzip
 import os
-import json
+import threading
+import time
+import orjson
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from dotenv import load_dotenv
+from dotenv import find_dotenv, load_dotenv, set_key
 
-load_dotenv()
+# Found by searching upwards from this script's directory, so refreshed tokens are
+# written back to the same file they were loaded from wherever the script is run
+ENV_FILE = find_dotenv()
+load_dotenv(ENV_FILE)
 
 # ---- CONFIG ----
 ACCESS_TOKEN = os.environ.get("STRAVA_ACCESS_TOKEN")
-REFRESH_TOKEN = os.environ.get("STRAVA_REFRESH_TOKEN")
 CLIENT_ID = os.environ.get("STRAVA_CLIENT_ID")
 CLIENT_SECRET = os.environ.get("STRAVA_CLIENT_SECRET")
-OUTPUT_FILE = "strava_activities_last_2_years.csv"
+OUTPUT_FILE = "strava_activities_last_2_years.csv.gz"  # Drop ".gz" for an uncompressed CSV
 SUMMARY_FILE = "strava_summary_by_sport.csv"
 DAYS_BACK = 730  # Two years
 PER_PAGE = 200
+MAX_WORKERS = 5  # Pages fetched in parallel
+RATE_LIMIT_THRESHOLD = 0.8  # Fraction of the 15 minute limit before backing off
+TOKEN_EXPIRY_MARGIN = 60  # Seconds before expiry at which the token is refreshed
+RATE_LIMIT_RETRIES = 3  # Times a rate limited request waits for the limit to reset
 # ----------------
 
+FIELDS = [
+    "id", "name", "sport_type", "start_date",
+    "distance_km", "moving_time_min", "elapsed_time_min",
+    "average_speed_kmph", "max_speed_kmph", "total_elevation_gain_m",
+    "average_heartrate", "max_heartrate", "calories",
+    "trainer", "commute",
+]
+
+# Shared session so every request to strava.com reuses pooled keep-alive connections.
+# Transient server errors are retried with backoff. Rate limiting (429) is left to
+# make_api_request, since Strava's 15 minute window outlasts any short backoff.
+RETRY = Retry(
+    total=3,
+    backoff_factor=1,
+    status_forcelist=(500, 502, 503, 504),
+    allowed_methods=("GET",)
+)
+# The token refresh spends a single-use refresh token, so it is only retried when
+# the server answered with an error, never after a read timeout or dropped response
+TOKEN_RETRY = Retry(
+    total=3,
+    read=0,
+    other=0,
+    backoff_factor=1,
+    status_forcelist=(500, 502, 503, 504),
+    allowed_methods=("POST",)
+)
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=10, max_retries=RETRY))
+SESSION.mount("https://www.strava.com/oauth/", HTTPAdapter(max_retries=TOKEN_RETRY))
+
+# Serializes token refreshes between the threads fetching pages
+TOKEN_LOCK = threading.Lock()
+
 def refresh_access_token():
     """Refresh the access token using the refresh token"""
-    if not all([REFRESH_TOKEN, CLIENT_ID, CLIENT_SECRET]):
+    # Read from the environment, since every refresh rotates the refresh token
+    refresh_token = os.environ.get("STRAVA_REFRESH_TOKEN")
+    if not all([refresh_token, CLIENT_ID, CLIENT_SECRET]):
         raise ValueError("Missing refresh token, client ID, or client secret for token refresh")
     
     print("Refreshing access token...")
     
-    response = requests.post(
+    response = SESSION.post(
         "https://www.strava.com/oauth/token",
         data={
             "client_id": CLIENT_ID,
             "client_secret": CLIENT_SECRET,
-            "refresh_token": REFRESH_TOKEN,
+            "refresh_token": refresh_token,
             "grant_type": "refresh_token"
-        }
+        },
+        timeout=30
     )
     
     if response.status_code != 200:
         raise Exception(f"Failed to refresh token: {response.status_code} - {response.text}")
     
-    data = response.json()
+    data = orjson.loads(response.content)
     
     # Update environment variables
     os.environ["STRAVA_ACCESS_TOKEN"] = data["access_token"]
     os.environ["STRAVA_REFRESH_TOKEN"] = data["refresh_token"]
     os.environ["STRAVA_TOKEN_EXPIRES_AT"] = str(data["expires_at"])
     
-    # Update .env file
-    env_content = f"""STRAVA_CLIENT_ID={CLIENT_ID}
-STRAVA_CLIENT_SECRET={CLIENT_SECRET}
-STRAVA_ACCESS_TOKEN={data['access_token']}
-STRAVA_REFRESH_TOKEN={data['refresh_token']}
-STRAVA_TOKEN_EXPIRES_AT={data['expires_at']}
-"""
-    with open(".env", "w") as f:
-        f.write(env_content)
+    # Update the tokens in place in the .env file, if there is one
+    if ENV_FILE:
+        set_key(ENV_FILE, "STRAVA_ACCESS_TOKEN", data["access_token"], quote_mode="never")
+        set_key(ENV_FILE, "STRAVA_REFRESH_TOKEN", data["refresh_token"], quote_mode="never")
+        set_key(ENV_FILE, "STRAVA_TOKEN_EXPIRES_AT", str(data["expires_at"]), quote_mode="never")
     
     print("Token refreshed successfully")
     return data["access_token"]
 
-def make_api_request(url, headers, params=None, max_retries=3):
-    """Make API request with retry logic and rate limiting"""
-    for attempt in range(max_retries):
-        try:
-            response = requests.get(url, headers=headers, params=params, timeout=30)
-            
-            # Handle rate limiting
-            if response.status_code == 429:
-                retry_after = int(response.headers.get('Retry-After', 60))
-                print(f"Rate limited. Waiting {retry_after} seconds...")
-                time.sleep(retry_after)
-                continue
-            
+def ensure_fresh_token():
+    """Refresh the access token ahead of time if it is about to expire"""
+    with TOKEN_LOCK:
+        expires_at = os.environ.get("STRAVA_TOKEN_EXPIRES_AT")
+        if expires_at and int(expires_at) - time.time() < TOKEN_EXPIRY_MARGIN:
+            SESSION.headers["Authorization"] = f"Bearer {refresh_access_token()}"
+
+def rate_limit_usage(response):
+    """Return (requests used, request limit) for the 15 minute window, from Strava's response headers"""
+    try:
+        short_usage = int(response.headers.get("X-RateLimit-Usage", "0,0").split(",")[0])
+        short_limit = int(response.headers.get("X-RateLimit-Limit", "0,0").split(",")[0])
+    except ValueError:
+        return 0, 0
+    return short_usage, short_limit
+
+def rate_limit_wait(response):
+    """Return seconds to wait after a 429: Retry-After if given, else until the 15 minute window resets"""
+    try:
+        return int(response.headers["Retry-After"])
+    except (KeyError, ValueError):
+        # Strava's short-term window resets on the quarter hour
+        return 15 * 60 - int(time.time()) % (15 * 60) + 1
+
+def make_api_request(url, params=None):
+    """Make API request, refreshing the access token once if it has expired
+
+    Rate limited requests wait for the limit to reset; transient server errors are
+    retried by the session's adapter. The body is left unread so read_json can
+    parse it straight off the socket.
+    """
+    try:
+        refreshed = False
+        rate_limited = 0
+        while True:
+            sent_auth = SESSION.headers["Authorization"]
+            response = SESSION.get(url, params=params, headers={"Authorization": sent_auth}, timeout=30, stream=True)
+
             # Handle token expiration
-            if response.status_code == 401:
-                if attempt == 0:  # Only try to refresh once
-                    try:
-                        new_token = refresh_access_token()
-                        headers["Authorization"] = f"Bearer {new_token}"
-                        continue
-                    except Exception as e:
-                        print(f"Failed to refresh token: {e}")
-                        raise
-            
-            if response.status_code == 200:
-                return response
-            
-            # For other errors, wait and retry
-            if attempt < max_retries - 1:
-                wait_time = 2 ** attempt  # Exponential backoff
-                print(f"Request failed (attempt {attempt + 1}/{max_retries}). Retrying in {wait_time}s...")
+            if response.status_code == 401 and not refreshed:
+                response.close()
+                refreshed = True
+                with TOKEN_LOCK:
+                    # Only refresh if no other thread has replaced the rejected token yet
+                    if SESSION.headers["Authorization"] == sent_auth:
+                        try:
+                            new_token = refresh_access_token()
+                            SESSION.headers["Authorization"] = f"Bearer {new_token}"
+                        except Exception as e:
+                            print(f"Failed to refresh token: {e}")
+                            raise
+                continue
+
+            # Handle rate limiting
+            if response.status_code == 429 and rate_limited < RATE_LIMIT_RETRIES:
+                response.close()
+                rate_limited += 1
+                wait_time = rate_limit_wait(response)
+                print(f"Rate limited. Waiting {wait_time} seconds...")
                 time.sleep(wait_time)
                 continue
-            
-            # Final attempt failed
+
+            break
+
+        if not response.ok:
+            response.close()
             response.raise_for_status()
-            
-        except requests.exceptions.RequestException as e:
-            if attempt == max_retries - 1:
-                raise Exception(f"API request failed after {max_retries} attempts: {e}")
-            wait_time = 2 ** attempt
-            print(f"Network error (attempt {attempt + 1}/{max_retries}). Retrying in {wait_time}s...")
-            time.sleep(wait_time)
-    
-    raise Exception("Unexpected error in API request")
+        return response
+
+    except requests.exceptions.RequestException as e:
+        raise Exception(f"API request failed: {e}")
+
+def read_json(response):
+    """Parse a streamed response body with orjson and release its connection"""
+    with response:
+        return orjson.loads(response.raw.read(decode_content=True))
+
+def page_columns(activities):
+    """Convert one page of activities into output columns, keyed by FIELDS"""
+    columns = {field: [] for field in FIELDS}
+    for activity in activities:
+        columns["id"].append(activity["id"])
+        columns["name"].append(activity.get("name"))
+        columns["sport_type"].append(activity.get("sport_type", activity["type"]))
+        columns["start_date"].append(activity["start_date_local"])
+        columns["distance_km"].append(round(activity.get("distance", 0) / 1000, 2))
+        columns["moving_time_min"].append(round(activity.get("moving_time", 0) / 60, 1))
+        columns["elapsed_time_min"].append(round(activity.get("elapsed_time", 0) / 60, 1))
+        columns["average_speed_kmph"].append(round(activity.get("average_speed", 0) * 3.6, 2))
+        columns["max_speed_kmph"].append(round(activity.get("max_speed", 0) * 3.6, 2))
+        columns["total_elevation_gain_m"].append(activity.get("total_elevation_gain"))
+        columns["average_heartrate"].append(activity.get("average_heartrate"))
+        columns["max_heartrate"].append(activity.get("max_heartrate"))
+        columns["calories"].append(activity.get("calories"))
+        columns["trainer"].append(activity.get("trainer", 0))
+        columns["commute"].append(activity.get("commute", 0))
+    return columns
 
 def main():
     if not ACCESS_TOKEN:
         raise ValueError("Missing STRAVA_ACCESS_TOKEN environment variable")
 
-    headers = {
-        "Authorization": f"Bearer {ACCESS_TOKEN}"
-    }
+    SESSION.headers["Authorization"] = f"Bearer {ACCESS_TOKEN}"
 
     url = "https://www.strava.com/api/v3/athlete/activities"
     after = int((datetime.now() - timedelta(days=DAYS_BACK)).timestamp())
     page = 1
-    all_activities = []
+    total_activities = 0
+    summary = defaultdict(lambda: [0.0, 0])  # sport_type -> [distance_km, activity_count]
 
     print("Fetching Strava activities for the past 2 years...")
     print(f"Fetching activities after: {datetime.fromtimestamp(after).strftime('%Y-%m-%d')}")
     print()
 
+    # Rows are streamed to a partial file as each page arrives, so only one page is
+    # held in memory. It replaces OUTPUT_FILE only once the whole fetch succeeds.
+    partial_file = OUTPUT_FILE + ".part"
+
     try:
-        while True:
-            params = {
-                "after": after,
-                "page": page,
-                "per_page": PER_PAGE
-            }
-
-            response = make_api_request(url, headers, params)
-            data = response.json()
-
-            if not data:
-                print(f"No more activities found. Total pages: {page - 1}")
-                break
-
-            for activity in data:
-                all_activities.append({
-                    "id": activity["id"],
-                    "name": activity["name"],
-                    "sport_type": activity.get("sport_type", activity["type"]),
-                    "start_date": activity["start_date_local"],
-                    "distance_km": round(activity.get("distance", 0) / 1000, 2),
-                    "moving_time_min": round(activity.get("moving_time", 0) / 60, 1),
-                    "elapsed_time_min": round(activity.get("elapsed_time", 0) / 60, 1),
-                    "average_speed_kmph": round(activity.get("average_speed", 0) * 3.6, 2),
-                    "max_speed_kmph": round(activity.get("max_speed", 0) * 3.6, 2),
-                    "total_elevation_gain_m": activity.get("total_elevation_gain", ""),
-                    "average_heartrate": activity.get("average_heartrate", ""),
-                    "max_heartrate": activity.get("max_heartrate", ""),
-                    "calories": activity.get("calories", ""),
-                    "trainer": activity.get("trainer", 0),
-                    "commute": activity.get("commute", 0),
-                })
-
-            print(f"Fetched page {page} with {len(data)} activities.")
-            page += 1
-            time.sleep(1)  # Avoid hitting rate limits
-
-        # Convert to DataFrame
-        if not all_activities:
+        window = MAX_WORKERS
+        last_page = None
+
+        open_output = gzip.open if OUTPUT_FILE.endswith(".gz") else open
+        with open_output(partial_file, "wt", newline="") as fh, ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            writer = csv.writer(fh)
+            writer.writerow(FIELDS)
+
+            while last_page is None:
+                ensure_fresh_token()
+
+                # Fetch the next window of pages in parallel
+                pages = range(page, page + window)
+                futures = [
+                    executor.submit(make_api_request, url, {
+                        "after": after,
+                        "page": p,
+                        "per_page": PER_PAGE
+                    })
+                    for p in pages
+                ]
+
+                usage = 0.0
+                short_limit = 0
+                for p, future in zip(pages, futures):
+                    response = future.result()
+                    data = read_json(response)
+                    used, limit = rate_limit_usage(response)
+                    if limit:
+                        usage = max(usage, used / limit)
+                        short_limit = limit
+
+                    if data:
+                        columns = page_columns(data)
+                        writer.writerows(zip(*(columns[field] for field in FIELDS)))
+                        for sport, distance_km in zip(columns["sport_type"], columns["distance_km"]):
+                            summary[sport][0] += distance_km
+                            summary[sport][1] += 1
+                        total_activities += len(data)
+                        print(f"Fetched page {p} with {len(data)} activities.")
+
+                    # A short page means there is nothing left after it
+                    if len(data) < PER_PAGE:
+                        last_page = p if data else p - 1
+                        break
+
+                # Release connections still held by pages past the end
+                for future in futures:
+                    if future.exception() is None:
+                        future.result().close()
+
+                page += window
+
+                if last_page is None and usage > RATE_LIMIT_THRESHOLD:
+                    # Near the 15 minute rate limit: fetch fewer pages at once and pace the
+                    # requests just made to the limit's average rate of one per 15*60/limit s
+                    delay = len(futures) * 15 * 60 / short_limit
+                    window = max(1, window // 2)
+                    print(f"Rate limit usage at {usage:.0%}. Fetching {window} pages at a time, waiting {delay:.0f}s...")
+                    time.sleep(delay)
+                elif window < MAX_WORKERS:
+                    # Back under the threshold, so grow the window again
+                    window = min(MAX_WORKERS, window * 2)
+
+        print(f"No more activities found. Total pages: {last_page}")
+
+        if not total_activities:
+            os.remove(partial_file)
             print("No activities found for the specified time period.")
             return
 
-        df = pd.DataFrame(all_activities)
-        df.fillna("", inplace=True)
-        df.to_csv(OUTPUT_FILE, index=False)
+        os.replace(partial_file, OUTPUT_FILE)
 
-        # Summary by sport type
-        summary_df = df.groupby("sport_type").agg({
-            "distance_km": "sum",
-            "id": "count"
-        }).rename(columns={"id": "activity_count"}).reset_index()
-        summary_df.to_csv(SUMMARY_FILE, index=False)
+        # Summary by sport type, from the totals accumulated while streaming
+        summary_rows = [
+            (sport, round(distance_km, 2), activity_count)
+            for sport, (distance_km, activity_count) in sorted(summary.items())
+        ]
+        with open(SUMMARY_FILE, "w", newline="") as fh:
+            writer = csv.writer(fh)
+            writer.writerow(["sport_type", "distance_km", "activity_count"])
+            writer.writerows(summary_rows)
 
         # Print summary
-        print(f"\nSuccess! Exported {len(df)} activities to {OUTPUT_FILE}")
+        print(f"\nSuccess! Exported {total_activities} activities to {OUTPUT_FILE}")
         print(f"Summary saved to {SUMMARY_FILE}")
         print(f"\nActivity Summary:")
-        for _, row in summary_df.iterrows():
-            print(f"  {row['sport_type']}: {row['activity_count']} activities, {row['distance_km']:.1f} km")
+        for sport, distance_km, activity_count in summary_rows:
+            print(f"  {sport}: {activity_count} activities, {distance_km:.1f} km")
 
     except Exception as e:
         print(f"Error: {e}")
+        if os.path.exists(partial_file):
+            print(f"Activities fetched so far were kept in {partial_file}; {OUTPUT_FILE} was left unchanged")
         return 1
+    finally:
+        SESSION.close()
 
 if __name__ == "__main__":
     exit(main())